@@ -7,179 +7,285 @@ from torch.utils.tensorboard import SummaryWriter
 from pytorch_adapt.validators import IMValidator # , SNDValidator
 
 
+class _Prefetcher:
+    # copies the next batch to the device on a side stream while the current batch is being used;
+    # only the batch positions in `fields` are moved, the rest are passed through untouched
+    def __init__(self, loader, device, fields=(0, 1, 2)):
+        self.loader = loader
+        self.device = device
+        self.fields = fields
+        self.stream = torch.cuda.Stream(device) if torch.device(device).type == "cuda" else None
+
+    def _to_device(self, batch):
+        return [t.to(self.device, non_blocking=True) if i in self.fields else t for i, t in enumerate(batch)]
+
+    def _preload(self, batches):
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+        batches = iter(self.loader)
+        next_batch = self._preload(batches)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            for i in self.fields: # keep the side-stream allocations alive until the main stream is done with them
+                batch[i].record_stream(current_stream)
+            next_batch = self._preload(batches)
+            yield batch
+
+
 class UncertaintyAwareGradualDomainEnsemble:
     def __init__(self, model, Z, z, slope, device="cpu"):
-        self.device = device
-        self.model = model.to(self.device)
+        self.device = device # loaders are expected to use pin_memory=True so the non_blocking copies in _Prefetcher are asynchronous
+        # NHWC lets cuDNN pick tensor-core friendly conv kernels; image batches are converted to match in _forward
+        self.memory_format = torch.channels_last if torch.device(self.device).type == "cuda" else torch.contiguous_format
+        # private copy: adapt() trains self.model in place, the caller's model must keep its weights
+        self.model = deepcopy(model).to(self.device, memory_format=self.memory_format)
         self.Z = Z.to(self.device) # intermediate values
         self.z = z.to(self.device)# temporal outputs
         self.slope = slope
         self.validator = IMValidator()
         self.pl_acc_list = []
+        self._loader_idx = dict() # loader -> sample indices into Z/z
+        # mixed precision forward on GPU: bf16 where supported, otherwise fp16 with loss scaling
+        self.amp_enabled = torch.device(self.device).type == "cuda"
+        self.amp_dtype = torch.bfloat16 if self.amp_enabled and torch.cuda.is_bf16_supported() else torch.float16
+        if hasattr(torch, "compile"): # torch>=2.0: fuse the small elementwise/reduction ops
+            self._pseudo_label_loss = torch.compile(self._pseudo_label_loss, fullgraph=True, dynamic=True)
+            self._entropy = torch.compile(self._entropy, fullgraph=True, dynamic=True)
+            self._entropy_from_logits = torch.compile(self._entropy_from_logits, fullgraph=True, dynamic=True)
 
-    def _adapt_train_epoch(self, model, train_loader, optimizer, alpha):
+    def _adapt_train_epoch(self, model, train_loader, optimizer, scaler, alpha):
         model.train()
-        total_loss = 0
-        total_num = 0
-        total_logits = []
-        for idx, data, _ in train_loader:
-            data = data.to(self.device)
-            student_logits = model(data)
-            ensemble_probs = self.z[idx]
-            loss, mask = self._pseudo_label_loss(student_logits, ensemble_probs, alpha)
+        # accumulate on the device and read the totals back once after the loop, not with a sync per batch
+        total_loss = torch.zeros((), device=self.device)
+        total_num = torch.zeros((), device=self.device)
+        total_correct = torch.zeros((), device=self.device)
+        total_pl_correct = torch.zeros((), device=self.device)
+        total_logits = self._domain_buffer(train_loader)
+        offset = 0
+        for idx, data, y in _Prefetcher(train_loader, self.device):
+            student_logits = self._forward(model, data)
+            teacher_pred = self._z_argmax[idx]
+            loss, mask = self._pseudo_label_loss(student_logits, self._z_conf[idx], teacher_pred, alpha)
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item() * mask.sum().item()
-            total_num += mask.sum().item()
-            total_logits.append(student_logits)
-        total_loss /= total_num
-        total_logits = torch.cat(total_logits)
-        score = self.validator(target_train={"logits": total_logits})
-        return total_loss, score
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            total_loss += loss.detach() * mask.sum()
+            total_num += mask.sum()
+            total_logits[offset:offset + data.shape[0]] = student_logits.detach()
+            offset += data.shape[0]
 
+            # accuracies come from the training forward pass instead of a separate eval pass
+            pred = torch.argmax(student_logits, dim=1)
+            total_correct += torch.eq(pred, y).sum()
+            total_pl_correct += torch.eq(teacher_pred, y).sum()
+        total_loss = (total_loss / total_num).item()
+        score = self.validator(target_train={"logits": total_logits[:offset]}) # the loader may yield fewer samples than the dataset holds
+        return total_loss, score, total_correct.item() / offset, total_pl_correct.item() / offset
+
+    @torch.inference_mode()
     def _adapt_eval_epoch(self, model, val_loader, alpha):
         model.eval()
-        total_loss = 0
-        total_num = 0
-        total_logits = []
-        for idx, data, _ in val_loader:
-            data = data.to(self.device)
-            student_logits = model(data)
-            ensemble_probs = self.z[idx]
-            loss, mask = self._pseudo_label_loss(student_logits, ensemble_probs, alpha)
-            total_loss += loss.item() * mask.sum().item()
-            total_num += mask.sum().item()
-            total_logits.append(student_logits)
-        total_loss /= total_num
-        total_logits = torch.cat(total_logits)
-        score = self.validator(target_train={"logits": total_logits})
+        total_loss = torch.zeros((), device=self.device)
+        total_num = torch.zeros((), device=self.device)
+        total_logits = self._domain_buffer(val_loader)
+        offset = 0
+        for idx, data, _ in _Prefetcher(val_loader, self.device, fields=(0, 1)):
+            student_logits = self._forward(model, data)
+            loss, mask = self._pseudo_label_loss(student_logits, self._z_conf[idx], self._z_argmax[idx], alpha)
+            total_loss += loss.detach() * mask.sum()
+            total_num += mask.sum()
+            total_logits[offset:offset + data.shape[0]] = student_logits.detach()
+            offset += data.shape[0]
+        total_loss = (total_loss / total_num).item()
+        score = self.validator(target_train={"logits": total_logits[:offset]}) # the loader may yield fewer samples than the dataset holds
         return total_loss, score
 
-    @torch.no_grad()
-    def _oracle_eval_epoch(self, model, val_loader):
-        model.eval()
-        total_correct = 0
-        total_pl_correct = 0
-        total_num = 0
-        for idx, data, y in val_loader:
-            data, y = data.to(self.device), y.to(self.device)
-            output = model(data)
-
-            pred = torch.argmax(output, dim=1)
-            total_correct += torch.eq(pred, y).sum().item()
+    def _forward(self, model, data):
+        if data.dim() == 4:
+            data = data.contiguous(memory_format=self.memory_format)
+        with torch.autocast(device_type="cuda", dtype=self.amp_dtype, enabled=self.amp_enabled):
+            logits = model(data)
+        # back to fp32 so softmax, entropy and losses stay in full precision
+        return logits.float()
 
-            pl = torch.argmax(self.z[idx], dim=1)
-            total_pl_correct += torch.eq(pl, y).sum().item()
-            total_num += data.shape[0]
-
-        return total_correct / total_num, total_pl_correct / total_num
+    def _domain_buffer(self, loader):
+        # one (N_d, C) buffer for per-sample logits or probs of a pass, filled in iteration order instead of list-append + torch.cat
+        return torch.empty(len(loader.dataset), self.z.shape[1], device=self.device)
 
     def _adapt_train_eval(self, domain_idx, domain2trainloader, confidence_q, args, val_loader=None):
-        # update Z first (given that Z is initialized to 0 and source model has been trained)
-        self._update_Z(domain2trainloader, domain_idx)
         train_loader = domain2trainloader[domain_idx]
         alpha = self._calc_alpha(train_loader, confidence_q) # calculate from Z (accumulated prediction)
 
-        model = deepcopy(self.model).to(self.device)
+        model = self.model # adapt() restores the pre-adaptation weights before every trial
 
         optimizer = torch.optim.Adam(model.parameters(), lr=args.adapt_lr)
+        scaler = torch.cuda.amp.GradScaler(enabled=self.amp_enabled and self.amp_dtype == torch.float16) # bf16 needs no scaling
+        history = []
         for e in range(1, args.adapt_epochs + 1):
-            train_loss, train_score = self._adapt_train_epoch(model, train_loader, optimizer, alpha)
-            train_acc, pl_acc = self._oracle_eval_epoch(model, train_loader)
+            train_loss, train_score, train_acc, pl_acc = self._adapt_train_epoch(model, train_loader, optimizer, scaler, alpha)
 
             print(f"Slope: {round(self.slope, 3)} Confidence q: {confidence_q} Epoch: {e} Train Loss: {train_loss} Train Acc: {train_acc} PL Acc: {pl_acc}")
+            history.append((train_loss, train_score))
+        # log after training so the epoch loop does no tensorboard I/O
+        for e, (train_loss, train_score) in enumerate(history, start=1):
             self.writer.add_scalar("Loss/train", train_loss, e)
             self.writer.add_scalar("Score/train", train_score, e)
+        self.writer.flush()
         self.pl_acc_list.append(pl_acc)
-        return model, train_score
+        return train_score
+
+    def _state_snapshot(self):
+        return {k: v.detach().clone() for k, v in self.model.state_dict().items()}
 
     def _entropy(self, probs):
-        entropies = -torch.sum(
-            probs * torch.log(probs + 1e-20), dim=1
-        )
+        entropies = torch.sum(torch.special.entr(probs), dim=1) # entr(0) = 0, no epsilon needed
         return torch.mean(entropies)
 
-    @torch.no_grad()
+    def _entropy_from_logits(self, logits, probs):
+        # H = logsumexp(x) - sum(softmax(x) * x), reusing the softmax the caller already has
+        entropies = torch.logsumexp(logits, dim=1) - torch.sum(probs * logits, dim=1)
+        return torch.mean(entropies)
+
+    @torch.inference_mode()
     def _update_Z(self, domain2trainloader, domain_idx):
         self.model.eval()
-        for d, loader in domain2trainloader.items():
-            if d < domain_idx: # only update future data points
-                continue
-            # print("updated domain:", d)
-            # TODO: Calculate momentum based on the current domain
-            if d == domain_idx:
-                total_ensemble_probs = []
-                total_current_probs = []
-                for idx, img, _ in loader:
-                    img = img.to(self.device)
-                    output = self.model(img)
+        # momentum is calculated based on the current domain and shared by all future data points
+        loader = domain2trainloader[domain_idx]
+        # a single forward pass: keep the probs until the momentum is known, then blend them all at once
+        current_entropy_sum = torch.zeros((), device=self.device)
+        total_idx = torch.empty(len(loader.dataset), dtype=torch.long, device=self.device)
+        total_probs = self._domain_buffer(loader)
+        total_num = 0
+        for idx, img, _ in _Prefetcher(loader, self.device, fields=(0, 1)):
+            output = self._forward(self.model, img)
+            probs = F.softmax(output, dim=1)
+            current_entropy_sum += self._entropy_from_logits(output, probs) * img.shape[0]
+            total_idx[total_num:total_num + img.shape[0]] = idx
+            total_probs[total_num:total_num + img.shape[0]] = probs
+            total_num += img.shape[0]
+        ensemble_avg_entropy = self._entropy(self.z[self._loader_indices(loader)]) # z is not touched by the loop
+        current_avg_entropy = current_entropy_sum / total_num
+        momentum = torch.clip(0.5 + self.slope * (current_avg_entropy - ensemble_avg_entropy), 0, 1) if domain_idx != 1 else torch.tensor(0.)
+        # momentum = torch.exp(-self.slope * ensemble_avg_entropy / current_avg_entropy) if domain_idx != 1 else torch.tensor(0.)
+        print(f"Domain Index: {domain_idx} Ensemble Entropy: {round(ensemble_avg_entropy.item(), 3)} Current Entropy: {round(current_avg_entropy.item(), 3)} Momentum: {round(momentum.item(), 3)}")
+        momentum = momentum.item()
+        if momentum < 1.0: # otherwise neither this domain nor the future ones would change
+            self._blend_Z(total_idx[:total_num], total_probs[:total_num], momentum) # the loader may yield fewer samples than the dataset holds
+            for d, future_loader in domain2trainloader.items():
+                if d <= domain_idx: # only update future data points
+                    continue
+                for idx, img, _ in _Prefetcher(future_loader, self.device, fields=(0, 1)):
+                    output = self._forward(self.model, img)
                     probs = F.softmax(output, dim=1)
-                    total_current_probs.append(probs)
-                    total_ensemble_probs.append(self.z[idx])
-                total_ensemble_probs = torch.cat(total_ensemble_probs)
-                total_current_probs = torch.cat(total_current_probs)
-                ensemble_avg_entropy = self._entropy(total_ensemble_probs)
-                current_avg_entropy = self._entropy(total_current_probs)
-                momentum = torch.clip(0.5 + self.slope * (current_avg_entropy - ensemble_avg_entropy), 0, 1) if domain_idx != 1 else torch.tensor(0.)
-                # momentum = torch.exp(-self.slope * ensemble_avg_entropy / current_avg_entropy) if domain_idx != 1 else torch.tensor(0.)
-                print(f"Domain Index: {d} Ensemble Entropy: {round(ensemble_avg_entropy.item(), 3)} Current Entropy: {round(current_avg_entropy.item(), 3)} Momentum: {round(momentum.item(), 3)}")
-            for idx, img, _ in loader:
-                img = img.to(self.device)
-                output = self.model(img)
-                probs = F.softmax(output, dim=1)
-                # print("domain idx", domain_idx, "before update:", self.z[idx][:5])
-                self.Z[idx] = momentum * self.Z[idx] + (1 - momentum) * probs
-                self.z[idx] = F.normalize(self.Z[idx], p=1)
-                # Check if self.z sums to 1
-                # print("domain idx", domain_idx, "after update:", self.z[idx][:5])
-                # print(torch.sum(self.z[idx][:3], dim=1))
+                    self._blend_Z(idx, probs, momentum)
 
     @torch.no_grad()
+    def _cache_z_stats(self):
+        # z stays fixed until the next update, so reduce it once instead of per batch.
+        # Not under inference_mode: these feed the (compiled) training loss and must be normal tensors.
+        self._z_conf = torch.amax(self.z, 1) - torch.amin(self.z, 1)
+        self._z_argmax = torch.argmax(self.z, dim=1)
+
+    def _blend_Z(self, idx, probs, momentum):
+        # Z[idx] gathers a copy, so blend that copy in place and write it back once
+        Z_slice = self.Z[idx]
+        Z_slice.mul_(momentum).add_(probs, alpha=1 - momentum)
+        self.Z[idx] = Z_slice
+        # Z is a blend of softmax outputs and never negative, so skip the abs that F.normalize(p=1) does
+        self.z[idx] = Z_slice.div_(Z_slice.sum(1, keepdim=True).clamp_min(1e-20))
+        # Check if self.z sums to 1
+        # print(torch.sum(self.z[idx][:3], dim=1))
+
+    @torch.no_grad() # alpha is an input of the training loss, so it must not be an inference tensor
     def _calc_alpha(self, loader, confidence_q):
         # find the quantile
-        total_prob = []
-        for idx, _, _ in loader:
-            total_prob.append(self.Z[idx])
-        total_prob = torch.cat(total_prob)
-        confidence = torch.amax(total_prob, 1) - torch.amin(total_prob, 1)
-        alpha = torch.quantile(confidence, confidence_q)
+        confidence = self._z_conf[self._loader_indices(loader)]
+        # selection instead of the full sort in torch.quantile; takes the lower of the two interpolated ranks
+        k = int(confidence_q * (confidence.numel() - 1)) + 1
+        alpha = torch.kthvalue(confidence, k).values
 
         return alpha
 
-    def _pseudo_label_loss(self, student_logits, ensemble_probs, alpha):
-        confidence = torch.amax(ensemble_probs, 1) - torch.amin(ensemble_probs, 1)
+    def _loader_indices(self, loader):
+        if loader not in self._loader_idx:
+            indices = self._dataset_indices(loader.dataset) if self._yields_whole_dataset(loader) else None
+            if indices is not None and len(indices) > 0:
+                # spot-check the resolved ids against the ids the dataset actually yields
+                last = len(loader.dataset) - 1
+                if int(loader.dataset[0][0]) != int(indices[0]) or int(loader.dataset[last][0]) != int(indices[last]):
+                    indices = None
+            if indices is None: # unrecognized dataset or sampler: collect the ids from one loader pass
+                indices = torch.cat([torch.as_tensor(idx) for idx, _, _ in loader])
+            self._loader_idx[loader] = indices.to(self.device)
+        return self._loader_idx[loader]
+
+    def _yields_whole_dataset(self, loader):
+        sampler = getattr(loader.batch_sampler, "sampler", None) # custom batch samplers are treated as unrecognized
+        return (isinstance(sampler, (torch.utils.data.SequentialSampler, torch.utils.data.RandomSampler))
+                and len(sampler) == len(loader.dataset) and not loader.drop_last)
+
+    def _dataset_indices(self, dataset):
+        # resolve the indices an indexed dataset yields without iterating (and loading) its samples; None if unknown
+        if isinstance(dataset, torch.utils.data.Subset):
+            indices = self._dataset_indices(dataset.dataset)
+            return indices[torch.as_tensor(dataset.indices)] if indices is not None else None
+        if isinstance(dataset, torch.utils.data.TensorDataset): # rotated mnist stores indices as its first tensor
+            return dataset.tensors[0]
+        if getattr(dataset, "indexed", False): # portraits / covertype yield their own position
+            return torch.arange(len(dataset))
+        return None
+
+    def _pseudo_label_loss(self, student_logits, confidence, teacher_pred, alpha):
         mask = confidence >= alpha
-        teacher_pred = torch.argmax(ensemble_probs, dim=1)
-        pseudo_loss = (F.nll_loss(F.log_softmax(student_logits, dim=1), teacher_pred, reduction='none') * mask).mean()
+        teacher_pred = torch.where(mask, teacher_pred, torch.full_like(teacher_pred, -100))
+        # sum over kept samples / full batch size, i.e. the masked mean the loss has always used
+        pseudo_loss = F.cross_entropy(student_logits, teacher_pred, ignore_index=-100, reduction='sum') / student_logits.shape[0]
         return pseudo_loss, mask
 
     def adapt(self, domain_idx, domain2trainloader, confidence_q_list, args, val_loader=None):
         # pseudo label train loader, val loader
-        performance_dict = dict()
+        for loader in domain2trainloader.values(): # resolve every domain's sample indices once, up front
+            self._loader_indices(loader)
+        # update Z first (given that Z is initialized to 0 and source model has been trained)
+        # self.model is the same for every confidence_q, so a single update is shared by all of them
+        self._update_Z(domain2trainloader, domain_idx)
+        self._cache_z_stats()
+        # every trial trains self.model in place from the same starting weights; only the best weights are kept
+        base_state = self._state_snapshot()
+        best_score = -np.inf
+        best_state = None
         for confidence_q in confidence_q_list:
             run_name = f"{args.method}_{self.slope}_{confidence_q}_{args.random_seed}"
             self.writer = SummaryWriter(os.path.join(args.log_dir, args.dataset, str(domain_idx), run_name))
-            model, val_score = self._adapt_train_eval(domain_idx, domain2trainloader, confidence_q, args, val_loader)
-            performance_dict[confidence_q] = {"model": model, "score": val_score}
-
-        best_score = -np.inf
-        best_model = None
-        for confidence_q, ckpt_dict in performance_dict.items():
-            if ckpt_dict["score"] > best_score:
-                best_model = ckpt_dict["model"]
-                best_score = ckpt_dict["score"]
+            self.model.load_state_dict(base_state)
+            val_score = self._adapt_train_eval(domain_idx, domain2trainloader, confidence_q, args, val_loader)
+            if val_score > best_score:
+                best_state = self._state_snapshot()
+                best_score = val_score
 
-        self.model = deepcopy(best_model).to(self.device)
+        self.model.load_state_dict(best_state)
 
+    @torch.inference_mode()
     def target_validate(self, val_loader):
-        total_logits = []
-        for _, img, _ in val_loader:
-            img = img.to(self.device)
-            logits = self.model(img)
-            total_logits.append(logits)
-        total_logits = torch.cat(total_logits)
-        score = self.validator(target_train={"logits": total_logits})
+        total_logits = self._domain_buffer(val_loader)
+        offset = 0
+        for _, img, _ in _Prefetcher(val_loader, self.device, fields=(1,)):
+            logits = self._forward(self.model, img)
+            total_logits[offset:offset + img.shape[0]] = logits.detach()
+            offset += img.shape[0]
+        score = self.validator(target_train={"logits": total_logits[:offset]}) # the loader may yield fewer samples than the dataset holds
         return score
 
     def get_model(self):